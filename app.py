@@ -7,9 +7,10 @@ import os
 import re
 import sqlite3
 import sys
+import urllib.parse
 
 # Third-party libraries
-from flask import Flask, redirect, request, url_for, render_template, make_response
+from flask import Flask, g, redirect, request, session, url_for, render_template, make_response
 from flask_login import (
     LoginManager,
     current_user,
@@ -21,29 +22,10 @@ from oauthlib.oauth2 import WebApplicationClient
 import requests
 
 # Internal imports
-from db import init_db_command, get_db, query_db
+from db import backup_db, init_app, init_db, get_db, get_snapshot_db, query_db
+from tenant import Tenant, current_tenant
 from user import User
 
-EVENT_TYPES = [
-        'academic',
-        'basketball',
-        'bowling',
-        'cross country',
-        'golf',
-        'lacrosse',
-        'mock trial',
-        'music',
-        'service',
-        'soccer',
-        'swimming',
-        'tennis',
-        'theater',
-        'track and field',
-        'trap',
-        'volleyball',
-        'other'
-];
-
 BASE_URL = os.getenv("BASE_URL")
 
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
@@ -60,25 +42,65 @@ app.config['PERMANENT_SESSION_LIFETIME'] =  datetime.timedelta(minutes=5)
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-try:
-    init_db_command()
-except sqlite3.OperationalError:
-    pass
+init_app(app)
+
+def init_tenant_dbs():
+    """create the tables on any new tenant db
+
+    Calling the init-db click command here would parse the flask cli's own
+    arguments and break every other command.
+    """
+    for tenant in Tenant.all():
+        with app.app_context():
+            g.tenant = tenant
+            try:
+                init_db()
+            except sqlite3.OperationalError:
+                pass
+
+init_tenant_dbs()
 
 if not app.debug:
     client = WebApplicationClient(GOOGLE_CLIENT_ID)
 
+@app.before_request
+def resolve_tenant():
+    """route this request to a school by hostname, else by the school the user logged in to"""
+    g.tenant = Tenant.resolve(request.host, session.get('tenant'))
+
 @login_manager.user_loader
 def load_user(user_id):
+    if g.get('tenant') is None:
+        return None
+
     return User.get(user_id)
 
+def get_callback_url():
+    """return the oauth callback url, on the school's own host if it has any
+
+    Schools without hosts use BASE_URL. Otherwise the host comes from the
+    school's config rather than the Host header, and the scheme from BASE_URL.
+    Each school's callback url must be registered with Google.
+    """
+    tenant = g.get('tenant')
+    if tenant is None or not tenant.hosts:
+        return f"{BASE_URL}/callback"
+
+    host = request.host.lower().split(':')[0]
+    if host not in tenant.hosts:
+        host = tenant.hosts[0]
+
+    scheme = urllib.parse.urlparse(BASE_URL).scheme if BASE_URL else request.scheme
+
+    return f"{scheme}://{host}/callback"
+
 def get_google_login_url():
     google_provider_cfg = get_google_provider_cfg()
     authorization_endpoint = google_provider_cfg["authorization_endpoint"]
 
     return client.prepare_request_uri(
         authorization_endpoint,
-        redirect_uri=f"{BASE_URL}/callback",
+        redirect_uri=get_callback_url(),
         scope=["openid", "email", "profile"],
     )
 
@@ -175,6 +197,69 @@ def get_num_bonus_points(db, event_date, event_type, num_points):
         return num_points
 
 
+def get_report_db():
+    """return the latest backup snapshot if requested with ?snapshot=1, otherwise the live db
+
+    Returns None if a snapshot was requested but there is no backup yet.
+    """
+    if request.args.get('snapshot'):
+        return get_snapshot_db()
+
+    return get_db()
+
+SEARCH_MODES = ['ranked', 'prefix', 'phrase']
+
+def make_search_query(q, mode):
+    """turn user search text into an fts5 match expression for the given mode"""
+    if mode not in SEARCH_MODES:
+        raise ValueError("unknown search mode: " + mode)
+
+    words = re.findall(r'\w+', q)
+    if not words:
+        return None
+
+    if mode == 'phrase':
+        return '"' + ' '.join(words) + '"'
+    elif mode == 'prefix':
+        return ' '.join(f'"{w}"*' for w in words)
+    else:
+        return ' '.join(f'"{w}"' for w in words)
+
+def has_search_index(db):
+    """return True if the points full text index has been created"""
+    return db.execute(
+        "select 1 from sqlite_master where type = 'table' and name = 'points_fts'"
+        ).fetchone() is not None
+
+def search_points(db, match, color=None, event_type=None, start_date=None, end_date=None):
+    """return up to 100 points matching the fts5 match expression, best matches first"""
+    where = ["points_fts match ?"]
+    params = [match]
+
+    if color:
+        where.append("p.color = ?")
+        params.append(color)
+    if event_type:
+        where.append("p.event_type = ?")
+        params.append(event_type)
+    if start_date:
+        where.append("p.event_date >= ?")
+        params.append(start_date)
+    if end_date:
+        where.append("p.event_date <= ?")
+        params.append(end_date)
+
+    return db.execute(f"""
+        select u.name, p.color, p.event_date, p.event_type, p.event_description, p.num_points
+            from
+                points_fts f join
+                points p on (p.rowid = f.rowid)
+                left join users u on (u.users_id = p.users_id)
+            where {' and '.join(where)}
+            order by f.rank, p.event_date desc
+            limit 100
+        """, params).fetchall()
+
 def need_login():
     if not current_user.is_authenticated:
         return True
@@ -210,7 +295,7 @@ def index():
         blue_points=blue_points,
         white_points=white_points,
         user=current_user,
-        event_types=EVENT_TYPES,
+        event_types=current_tenant().event_types,
         latest_points=latest_points,
         today=today,
         point=point,
@@ -281,7 +366,7 @@ def admin_points():
 
     today = datetime.datetime.now().strftime("%Y-%m-%d")
     if not request.form.get("submit", False):
-        return render_template("admin_points.html", today=today, event_types=EVENT_TYPES)
+        return render_template("admin_points.html", today=today, event_types=current_tenant().event_types)
 
     db = get_db()
 
@@ -292,7 +377,7 @@ def admin_points():
         else:
             message = "Email not found."
             return render_template("admin_points.html", 
-                today=today, event_types=EVENT_TYPES, message=message)
+                today=today, event_types=current_tenant().event_types, message=message)
 
     current_id = current_user.users_id
 
@@ -319,6 +404,48 @@ def admin_points():
 
     return redirect(url_for("index", message="Points added!"))
 
+@app.route("/search", methods=['GET'])
+def search():
+    """search points by event description"""
+    if need_login():
+        if app.debug:
+            dev_login()
+        else:
+            return redirect(get_google_login_url())
+
+    q = request.args.get('q', '')
+    mode = request.args.get('mode', 'ranked')
+    color = request.args.get('color', '')
+    event_type = request.args.get('event_type', '')
+    start_date = request.args.get('start_date', '')
+    end_date = request.args.get('end_date', '')
+
+    if mode not in SEARCH_MODES:
+        return redirect(url_for("message", m="unknown search mode."))
+
+    db = get_db()
+
+    if not has_search_index(db):
+        return redirect(url_for("message", m="search index missing, run flask index-points."))
+
+    points = []
+    if match := make_search_query(q, mode):
+        points = search_points(db, match,
+            color=color, event_type=event_type, start_date=start_date, end_date=end_date)
+
+    return render_template(
+        'search.html',
+        q=q,
+        mode=mode,
+        color=color,
+        event_type=event_type,
+        start_date=start_date,
+        end_date=end_date,
+        modes=SEARCH_MODES,
+        event_types=current_tenant().event_types,
+        points=points,
+    )
+
 @app.route("/bonus_points", methods=['GET', 'POST'])
 def bonus_points():
     """display or process bonus points page"""
@@ -340,7 +467,7 @@ def bonus_points():
     if not request.form.get("submit", False):
         return render_template("bonus_points.html", 
                     today=today,
-                    event_types=EVENT_TYPES,
+                    event_types=current_tenant().event_types,
                     bonus_points=bonus_points)
 
     require_vars(['total_points', 'start_date', 'end_date'])
@@ -373,7 +500,9 @@ def download_weekly_points():
     if not current_user.admin:
         return redirect(url_for("message", m="admin account required."))
 
-    db = get_db()
+    db = get_report_db()
+    if db is None:
+        return redirect(url_for("message", m="no backup snapshot available."))
 
     points = db.execute("""
         select datetime(p.event_date, 'weekday 3') wednesday, p.color,
@@ -413,7 +542,9 @@ def download_points():
     if not current_user.admin:
         return redirect(url_for("message", m="admin account required."))
 
-    db = get_db()
+    db = get_report_db()
+    if db is None:
+        return redirect(url_for("message", m="no backup snapshot available."))
 
     points = db.execute("""
         select u.users_id, u.email, u.name, u.color user_color,
@@ -443,6 +574,22 @@ def download_points():
 
         return output
 
+@app.route("/backup", methods=['POST'])
+def backup():
+    """make a verified online backup of the points db"""
+    if need_login():
+        if app.debug:
+            dev_login()
+        else:
+            return redirect(get_google_login_url())
+
+    if not current_user.admin:
+        return redirect(url_for("message", m="admin account required."))
+
+    path = backup_db()
+
+    return redirect(url_for("message", m=f"Backed up points to {os.path.basename(path)}."))
+
 def dev_login():
     if 'users_id' not in request.args or request.args['users_id'] == '':
         user = User.get_first_admin_user()
@@ -467,7 +614,7 @@ def callback():
     token_url, headers, body = client.prepare_token_request(
         token_endpoint,
         authorization_response=request.url,
-        redirect_url=f"{BASE_URL}/callback",
+        redirect_url=get_callback_url(),
         code=code
     )
     token_response = requests.post(
@@ -489,9 +636,12 @@ def callback():
     else:
         raise ValueError("User email not available or not verified by Google.")
 
-    if not (users_email.endswith('@stmarysschool.org') or
-        users_email.endswith('@stmarysmemphis.net')):
-        return redirect(url_for("message", m="Google account must belong to SMS"))
+    tenant = Tenant.for_host(request.host) or Tenant.for_email(users_email)
+    if not tenant or not tenant.owns_email(users_email):
+        return redirect(url_for("message", m="Google account must belong to a member school"))
+
+    session['tenant'] = tenant.name
+    g.tenant = tenant
 
     db = get_db()
 
@@ -511,6 +661,7 @@ def callback():
 @login_required
 def logout():
     logout_user()
+    session.pop('tenant', None)
     return redirect(url_for("index"))
 
 
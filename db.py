@@ -1,36 +1,160 @@
 # http://flask.pocoo.org/docs/1.0/tutorial/database/
+import datetime
+import glob
+import os
+import pathlib
 import sqlite3
+import tempfile
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
-def get_raw_db():
+from tenant import Tenant, current_tenant
+
+DB_PATH = "points.db"
+
+# online backups are written to a directory per tenant under BACKUP_DIR,
+# keeping the newest BACKUP_KEEP copies
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+
+# pages copied per step and seconds slept between steps, so writers are never
+# locked out for more than one small batch
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "256"))
+BACKUP_SLEEP = float(os.getenv("BACKUP_SLEEP", "0.05"))
+
+def get_raw_db(path=DB_PATH):
     """get db directly, without looking in the flask g first"""
-    db = sqlite3.connect("points.db", detect_types=sqlite3.PARSE_DECLTYPES)
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
     db.row_factory = sqlite3.Row
 
     return db
 
  
 def get_db():
+    """get the db of the current tenant, opening it if this request hasn't yet"""
     if "db" not in g:
-        g.db = get_raw_db()
+        tenant = current_tenant()
+        tenant.acquire_connection()
+        try:
+            g.db = get_raw_db(tenant.db_path)
+        except Exception:
+            tenant.release_connection()
+            raise
+        g.db_tenant = tenant
 
     return g.db
 
 def close_db(e=None):
     db = g.pop("db", None)
+    tenant = g.pop("db_tenant", None)
+    snapshot_db = g.pop("snapshot_db", None)
 
     if db is not None:
         db.close()
 
+    if snapshot_db is not None:
+        snapshot_db.close()
+
+    if tenant is not None:
+        tenant.release_connection()
+
+def init_search(db):
+    """create the full text index on points and its triggers if they are missing"""
+    with current_app.open_resource("search.sql") as f:
+        db.executescript(f.read().decode("utf8"))
+
 def init_db():
     db = get_db()
 
     with current_app.open_resource("schema.sql") as f:
         db.executescript(f.read().decode("utf8"))
 
+    init_search(db)
+
+def get_backup_dir():
+    """return the backup directory of the current tenant"""
+    return os.path.join(BACKUP_DIR, current_tenant().name)
+
+def list_backups():
+    """return the paths of the current tenant's backups, oldest first"""
+    return sorted(glob.glob(os.path.join(get_backup_dir(), "points-*.db")))
+
+def get_read_only_uri(path):
+    """return a sqlite uri opening the db at path read only"""
+    return pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+
+def verify_backup(path):
+    """raise a ValueError if the backup at path fails sqlite's integrity check"""
+    db = sqlite3.connect(get_read_only_uri(path), uri=True)
+    try:
+        result = [row[0] for row in db.execute("pragma integrity_check")]
+    finally:
+        db.close()
+
+    if result != ['ok']:
+        raise ValueError(f"backup {path} failed integrity check: {'; '.join(result)}")
+
+def rotate_backups(keep=BACKUP_KEEP):
+    """delete all but the newest keep backups, returning the deleted paths"""
+    backups = list_backups()
+    expired = backups[:-keep] if keep > 0 else []
+    for path in expired:
+        os.remove(path)
+
+    return expired
+
+def backup_db(pages=BACKUP_PAGES, sleep=BACKUP_SLEEP):
+    """copy the tenant's live db to a new backup file using the sqlite backup api
+
+    The copy is made pages at a time with a pause between batches so writers
+    can get in while the backup is running. The new backup is integrity
+    checked before old backups are rotated out. Returns the new backup path.
+    """
+    backup_dir = get_backup_dir()
+    os.makedirs(backup_dir, exist_ok=True)
+
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    path = os.path.join(backup_dir, f"points-{stamp}.db")
+
+    # a unique partial file, so backups started in the same instant don't collide
+    fd, partial = tempfile.mkstemp(dir=backup_dir, suffix=".partial")
+    os.close(fd)
+
+    # back up through this request's connection rather than taking another slot
+    src = get_db()
+    try:
+        dst = sqlite3.connect(partial)
+        try:
+            src.backup(dst, pages=pages, sleep=sleep)
+        finally:
+            dst.close()
+
+        verify_backup(partial)
+    except Exception:
+        os.remove(partial)
+        raise
+
+    os.replace(partial, path)
+    rotate_backups()
+
+    return path
+
+def get_snapshot_db():
+    """get a read only connection to the latest backup, or None if there is none"""
+    if "snapshot_db" not in g:
+        backups = list_backups()
+        if not backups:
+            return None
+
+        db = sqlite3.connect(get_read_only_uri(backups[-1]), uri=True,
+            detect_types=sqlite3.PARSE_DECLTYPES)
+        db.row_factory = sqlite3.Row
+        g.snapshot_db = db
+
+    return g.snapshot_db
+
 def query_db(db, query, params):
   """Returns data from an SQL query as a list of dicts."""
   try:
@@ -41,13 +165,77 @@ def query_db(db, query, params):
       print(f"Failed to execute. Query: {query}\n with error:\n{e}")
       return []
 
+def use_tenant(name):
+    """route get_db to the named tenant for the rest of this cli command"""
+    if name is None:
+        if Tenant.resolve('') is None:
+            raise click.UsageError("--tenant is required when several tenants are configured")
+        return
+
+    tenant = Tenant.get(name)
+    if not tenant:
+        raise click.BadParameter(f"unknown tenant {name}", param_hint="--tenant")
+
+    g.tenant = tenant
+
 @click.command("init-db")
+@click.option("--tenant", default=None, help="name of the tenant to use")
 @with_appcontext
-def init_db_command():
+def init_db_command(tenant):
     """Clear the existing data and create new tables."""
+    use_tenant(tenant)
     init_db()
     click.echo("Initialized the database.")
 
+@click.command("index-points")
+@click.option("--tenant", default=None, help="name of the tenant to use")
+@with_appcontext
+def index_points_command(tenant):
+    """Create the points full text index and rebuild it from existing points."""
+    use_tenant(tenant)
+    db = get_db()
+    init_search(db)
+    db.execute("insert into points_fts(points_fts) values ('rebuild')")
+    db.commit()
+    click.echo("Indexed the points.")
+
+@click.command("backup-db")
+@click.option("--pages", default=BACKUP_PAGES, help="pages to copy per step")
+@click.option("--sleep", default=BACKUP_SLEEP, help="seconds to sleep between steps")
+@click.option("--tenant", default=None, help="name of the tenant to use")
+@with_appcontext
+def backup_db_command(pages, sleep, tenant):
+    """Make a verified online backup of the database."""
+    use_tenant(tenant)
+    path = backup_db(pages=pages, sleep=sleep)
+    click.echo(f"Backed up the database to {path}.")
+
+@click.command("add-tenant")
+@click.argument("name")
+@click.option("--domain", "domains", multiple=True, required=True,
+    help="email domain of the school's google accounts")
+@click.option("--host", "hosts", multiple=True, help="hostname the school is served on")
+@click.option("--db", default=None, help="sqlite file for the school (default points-NAME.db)")
+@with_appcontext
+def add_tenant_command(name, domains, hosts, db):
+    """Add a school and create its database."""
+    tenant = Tenant(name, list(domains), hosts=list(hosts), db=db)
+
+    try:
+        Tenant.add(tenant)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    if not os.path.exists(tenant.db_path):
+        g.tenant = tenant
+        init_db()
+        get_db().commit()
+
+    click.echo(f"Added tenant {name} using {tenant.db_path}.")
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(index_points_command)
+    app.cli.add_command(backup_db_command)
+    app.cli.add_command(add_tenant_command)
@@ -7,6 +7,7 @@ import sys
 
 # Internal imports
 from db import get_raw_db, query_db
+from tenant import Tenant
 from user import User
 
 # number of points to give to each teacher
@@ -51,14 +52,26 @@ def insert_user(db, user):
                 [users_id, STARTING_TEACHER_POINTS]);
 
 def main():
-    db = get_raw_db()
-
     if len(sys.argv) < 2:
-        print(f"usage: {sys.argv[0]} <csv file>", file=sys.stderr)
+        print(f"usage: {sys.argv[0]} <csv file> [tenant]", file=sys.stderr)
         return
 
     csv_file = sys.argv[1]
 
+    if len(sys.argv) > 2:
+        tenant = Tenant.get(sys.argv[2])
+        if not tenant:
+            print(f"unknown tenant {sys.argv[2]}", file=sys.stderr)
+            return
+    else:
+        tenant = Tenant.resolve('')
+        if not tenant:
+            print(f"usage: {sys.argv[0]} <csv file> <tenant> (several tenants are configured)",
+                file=sys.stderr)
+            return
+
+    db = get_raw_db(tenant.db_path)
+
     users = []
     with open(csv_file, 'r') as data:
         for user in csv.DictReader(data):
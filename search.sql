@@ -0,0 +1,24 @@
+create virtual table if not exists points_fts using fts5(
+    event_description,
+    content='points',
+    content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+
+create trigger if not exists points_fts_insert after insert on points begin
+    insert into points_fts(rowid, event_description)
+        values (new.rowid, new.event_description);
+end;
+
+create trigger if not exists points_fts_delete after delete on points begin
+    insert into points_fts(points_fts, rowid, event_description)
+        values ('delete', old.rowid, old.event_description);
+end;
+
+create trigger if not exists points_fts_update after update of event_description on points begin
+    insert into points_fts(points_fts, rowid, event_description)
+        values ('delete', old.rowid, old.event_description);
+    insert into points_fts(rowid, event_description)
+        values (new.rowid, new.event_description);
+end;
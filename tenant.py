@@ -0,0 +1,188 @@
+import json
+import os
+import re
+import threading
+
+from flask import g
+
+# tenants are read from TENANTS_FILE; without one the app serves a single school
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json")
+
+# most sqlite connections one tenant may have open at once, and how many
+# seconds a request waits for one, so a busy school can't starve the others
+TENANT_MAX_CONNECTIONS = int(os.getenv("TENANT_MAX_CONNECTIONS", "8"))
+TENANT_CONNECTION_TIMEOUT = float(os.getenv("TENANT_CONNECTION_TIMEOUT", "10"))
+
+# most sqlite connections open at once across all tenants in this process
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "32"))
+
+# tenant names are used in db and backup paths
+TENANT_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+EVENT_TYPES = [
+        'academic',
+        'basketball',
+        'bowling',
+        'cross country',
+        'golf',
+        'lacrosse',
+        'mock trial',
+        'music',
+        'service',
+        'soccer',
+        'swimming',
+        'tennis',
+        'theater',
+        'track and field',
+        'trap',
+        'volleyball',
+        'other'
+];
+
+_lock = threading.Lock()
+_tenants = None
+_tenants_mtime = None
+_connections = {}
+_all_connections = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+class Tenant:
+    def __init__(self, name, domains, hosts=None, db=None, event_types=None):
+        if not TENANT_NAME_RE.match(name):
+            raise ValueError(f"invalid tenant name {name}: use letters, digits, - and _")
+
+        self.name = name
+        self.domains = [d.lower() for d in domains]
+        self.hosts = [h.lower() for h in (hosts or [])]
+        self.db_path = db or f"points-{name}.db"
+        self.event_types = event_types or EVENT_TYPES
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'domains': self.domains,
+            'hosts': self.hosts,
+            'db': self.db_path,
+            'event_types': self.event_types,
+        }
+
+    def owns_email(self, email):
+        """return True if email belongs to one of this tenant's domains"""
+        return email.lower().rsplit('@', 1)[-1] in self.domains
+
+    def acquire_connection(self):
+        """wait for one of this tenant's connection slots and one of the process's,
+        raising a RuntimeError on timeout"""
+        slots = _connection_slots(self.name)
+        if not slots.acquire(timeout=TENANT_CONNECTION_TIMEOUT):
+            raise RuntimeError(f"too many open connections for tenant {self.name}")
+
+        if not _all_connections.acquire(timeout=TENANT_CONNECTION_TIMEOUT):
+            slots.release()
+            raise RuntimeError("too many open connections")
+
+    def release_connection(self):
+        _all_connections.release()
+        _connection_slots(self.name).release()
+
+    @staticmethod
+    def all():
+        """return all tenants, rereading TENANTS_FILE if it has changed"""
+        global _tenants, _tenants_mtime
+
+        with _lock:
+            try:
+                mtime = os.path.getmtime(TENANTS_FILE)
+            except OSError:
+                mtime = None
+
+            if _tenants is None or mtime != _tenants_mtime:
+                _tenants = _load_tenants() if mtime is not None else [DEFAULT_TENANT]
+                _tenants_mtime = mtime
+
+            return _tenants
+
+    @staticmethod
+    def get(name):
+        for tenant in Tenant.all():
+            if tenant.name == name:
+                return tenant
+
+        return None
+
+    @staticmethod
+    def for_host(host):
+        """return the tenant serving host, ignoring any port"""
+        host = host.lower().split(':')[0]
+        for tenant in Tenant.all():
+            if host in tenant.hosts:
+                return tenant
+
+        return None
+
+    @staticmethod
+    def for_email(email):
+        """return the tenant that owns the domain of email"""
+        for tenant in Tenant.all():
+            if tenant.owns_email(email):
+                return tenant
+
+        return None
+
+    @staticmethod
+    def resolve(host, name=None):
+        """return the tenant for host, else the one named name, else the only tenant"""
+        if tenant := Tenant.for_host(host):
+            return tenant
+
+        if name and (tenant := Tenant.get(name)):
+            return tenant
+
+        tenants = Tenant.all()
+        if len(tenants) == 1:
+            return tenants[0]
+
+        return None
+
+    @staticmethod
+    def add(tenant):
+        """add tenant to TENANTS_FILE, raising a ValueError if the name, a domain
+        or a host is already taken"""
+        global _tenants
+
+        tenants = Tenant.all()
+        for t in tenants:
+            if t.name == tenant.name:
+                raise ValueError(f"tenant {tenant.name} already exists")
+            if domains := set(t.domains) & set(tenant.domains):
+                raise ValueError(f"domain {', '.join(sorted(domains))} already belongs to tenant {t.name}")
+            if hosts := set(t.hosts) & set(tenant.hosts):
+                raise ValueError(f"host {', '.join(sorted(hosts))} already belongs to tenant {t.name}")
+
+        with open(TENANTS_FILE, 'w') as f:
+            json.dump([t.to_dict() for t in tenants + [tenant]], f, indent=4)
+
+        with _lock:
+            _tenants = None
+
+DEFAULT_TENANT = Tenant('sms', ['stmarysschool.org', 'stmarysmemphis.net'], db='points.db')
+
+def _load_tenants():
+    with open(TENANTS_FILE, 'r') as f:
+        return [Tenant(**t) for t in json.load(f)]
+
+def _connection_slots(name):
+    with _lock:
+        if name not in _connections:
+            _connections[name] = threading.BoundedSemaphore(TENANT_MAX_CONNECTIONS)
+
+        return _connections[name]
+
+def current_tenant():
+    """return the tenant for the current request or cli command"""
+    tenant = g.get("tenant")
+    if tenant is None:
+        tenant = Tenant.resolve('')
+    if tenant is None:
+        raise RuntimeError("no tenant for this request")
+
+    return tenant